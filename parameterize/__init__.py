@@ -1,13 +1,34 @@
-from parameterize.home import home as __home
 from parameterize.version import version as _version
-import os
 import logging.config
 
 __version__ = _version()
 
+_LOG_CONFIG = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "simpleFormatter": {
+            "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+        }
+    },
+    "handlers": {
+        "consoleHandler": {
+            "class": "logging.StreamHandler",
+            "formatter": "simpleFormatter",
+            "stream": "ext://sys.stderr",
+        }
+    },
+    "loggers": {
+        "parameterize": {
+            "level": "INFO",
+            "handlers": ["consoleHandler"],
+            "propagate": False,
+        }
+    },
+    "root": {"level": "INFO", "handlers": ["consoleHandler"]},
+}
+
 try:
-    logging.config.fileConfig(
-        os.path.join(__home(), "logging.ini"), disable_existing_loggers=False
-    )
+    logging.config.dictConfig(_LOG_CONFIG)
 except:
     print("Parameterize: Logging setup failed")
@@ -113,6 +113,13 @@ def getArgumentParser():
         choices=["None", "qm", "mm"],
         help="Type of structure optimization when scanning dihedral angles (default: %(default)s)",
     )
+    parser.add_argument(
+        "--mm-workers",
+        default=1,
+        type=int,
+        help="Number of threads minimizing the rotamers concurrently with MM, when scanning "
+        "dihedral angles (default: %(default)s)",
+    )
     parser.add_argument(
         "--dihed-num-iterations",
         default=3,
@@ -167,6 +174,13 @@ def getArgumentParser():
         dest="fake_qm",
         help=argparse.SUPPRESS,
     )
+    parser.add_argument(
+        "--fake-qm-nprocs",
+        default=1,
+        type=int,
+        dest="fake_qm_nprocs",
+        help=argparse.SUPPRESS,
+    )
 
     # NNP module name
     parser.add_argument("--nnp", help=argparse.SUPPRESS)
@@ -198,7 +212,7 @@ def _printArguments(args, filename=None):
 
     logger.info("=== Arguments ===")
     for key, value in sorted(vars(args).items()):
-        if key in ("fake_qm", "max_jobs", "pm_token"):  # Hidden
+        if key in ("fake_qm", "fake_qm_nprocs", "max_jobs", "pm_token"):  # Hidden
             continue
         logger.info("{:>20s}: {:s}".format(key, str(value)))
 
@@ -433,6 +447,7 @@ def _get_qm_calculator(args, queue):
     # Override with a FakeQM object
     if args.fake_qm:
         qm = FakeQM2()
+        qm.nprocs = args.fake_qm_nprocs
         logger.warning("Using FakeQM")
 
     # Configure the QM object
@@ -930,6 +945,7 @@ def main_parameterize(arguments=None, progress=None):
             args.outdir,
             scan_type=args.dihed_opt_type,
             mm_minimizer=mm_minimizer,
+            max_workers=args.mm_workers,
         )
 
         # Filter scan results
@@ -6,7 +6,7 @@
 import logging
 import os
 
-import networkx as nx
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
@@ -14,15 +14,20 @@ logger = logging.getLogger(__name__)
 def _getMolecularGraph(molecule):
     """
     Generate a graph from the topology of molecule
+
+    The graph is returned as an adjacency list, a dictionary mapping sorted atom index pairs
+    to bond indices, and an array of atom elements.
     """
 
-    graph = nx.Graph()
-    for i in range(molecule.numAtoms):
-        graph.add_node(i, element=molecule.element[i])
-    for i, bond in enumerate(molecule.bonds):
-        graph.add_edge(*bond, index=i)
+    neighbors = [[] for _ in range(molecule.numAtoms)]
+    bond_index = {}
+    for i, (a, b) in enumerate(molecule.bonds):
+        a, b = int(a), int(b)
+        neighbors[a].append(b)
+        neighbors[b].append(a)
+        bond_index[(min(a, b), max(a, b))] = i
 
-    return graph
+    return neighbors, bond_index, molecule.element
 
 
 def fixPhosphateTypes(molecule):
@@ -95,22 +100,28 @@ def fixPhosphateTypes(molecule):
     """
 
     molecule = molecule.copy()
-    graph = _getMolecularGraph(molecule)
 
-    for node in graph.nodes:
+    # Nothing to fix without P atoms
+    if not np.any(molecule.element == "P"):
+        return molecule
 
-        # Skip not P atoms
-        if graph.nodes[node]["element"] != "P":
-            continue
+    adjacency, bond_indices, elements = _getMolecularGraph(molecule)
+    degrees = np.fromiter(
+        (len(neighbors) for neighbors in adjacency),
+        dtype=np.int32,
+        count=molecule.numAtoms,
+    )
+
+    # Iterate P atoms only
+    for node in np.flatnonzero(elements == "P"):
 
         # Skip P atom without 4 atoms connected
-        neighbors = list(graph.neighbors(node))
-        if len(neighbors) != 4:
+        if degrees[node] != 4:
             continue
+        neighbors = np.array(adjacency[node], dtype=int)
 
         # Filter O atoms
-        is_oxygen = lambda node: graph.nodes[node]["element"] == "O"
-        neighbors = filter(is_oxygen, neighbors)
+        neighbors = neighbors[elements[neighbors] == "O"]
 
         # Sort O atoms according to descending charge
         # Note: a double bond has to be near the most positive oxygen
@@ -121,10 +132,10 @@ def fixPhosphateTypes(molecule):
 
         # Iterate O atoms
         for neighbor in neighbors:
-            assert graph.nodes[neighbor]["element"] == "O"
+            assert elements[neighbor] == "O"
 
             # Get O atom and P--O bond type
-            num_bonds = len(list(graph.neighbors(neighbor)))
+            num_bonds = int(degrees[neighbor])
             if num_bonds == 2:
                 new_atom = "O.3"
                 new_bond = "1"
@@ -149,7 +160,7 @@ def fixPhosphateTypes(molecule):
                 )
 
             # Change the P--O bond type
-            bond_index = graph.edges[(node, neighbor)]["index"]
+            bond_index = bond_indices[(min(node, neighbor), max(node, neighbor))]
             old_bond = molecule.bondtype[bond_index]
             if old_bond != new_bond:
                 molecule.bondtype[bond_index] = new_bond
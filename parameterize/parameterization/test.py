@@ -354,6 +354,17 @@ class _TestParameterize(unittest.TestCase):
         )
         self._test(refDir, resDir)
 
+    def test_h2o2_full_fake_nprocs(self):
+        refDir = os.path.join(self.dataDir, "h2o2_full_fake")
+        resDir = os.path.join(self.testDir, "h2o2_full_fake_nprocs")
+        self._run(
+            refDir,
+            resDir,
+            "parameterize input.mol2 --min-type qm --charge-type ESP "
+            "--scan-type qm --fake-qm --fake-qm-nprocs 2",
+        )
+        self._test(refDir, resDir)
+
     def test_h2o2_full_fake_restart(self):
         refDir = os.path.join(self.dataDir, "h2o2_full_fake_restart")
         resDir = os.path.join(self.testDir, "h2o2_full_fake_restart")
@@ -710,6 +721,18 @@ class _TestParameterize(unittest.TestCase):
         )
         self._test(refDir, resDir, energyProfileAbsTol=2.1e-3)
 
+    def test_glycol_dihed_opt_mm_fake_workers(self):
+        refDir = os.path.join(self.dataDir, "glycol_dihed_opt_mm_fake_workers")
+        resDir = os.path.join(self.testDir, "glycol_dihed_opt_mm_fake_workers")
+        self._run(
+            refDir,
+            resDir,
+            "parameterize input.mol2 --forcefield GAFF2 --min-type None "
+            "--charge-type Gasteiger --scan-type mm --dihed-fit-type iterative "
+            "--dihed-num-iterations 0 --fake-qm --mm-workers 2",
+        )
+        self._test(refDir, resDir, energyProfileAbsTol=2.1e-3)
+
     def test_glycol_min_mm_fake(self):
         refDir = os.path.join(self.dataDir, "glycol_min_mm_fake")
         resDir = os.path.join(self.testDir, "glycol_min_mm_fake")
@@ -8,10 +8,18 @@ import logging
 import re
 import os
 import subprocess
-from tempfile import TemporaryDirectory, TemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from functools import lru_cache
+from tempfile import TemporaryDirectory
 
 logger = logging.getLogger(__name__)
 
+# Split an atom name into a prefix and a numeric suffix
+_NAME_RE = re.compile(r"(.*?\D*)(\d*)$")
+_PLUS_RE = re.compile(r"\+")
+_STAR_RE = re.compile(r"\*")
+
 
 def guessElements(mol, method):
     """
@@ -33,34 +41,39 @@ def guessElements(mol, method):
 
     mol = mol.copy()
 
-    for i, name in enumerate(mol.name):
+    # Match all atom names against all elements at once
+    valid_elements = np.array(elements[method], dtype=object)
+    names = np.char.capitalize(mol.name.astype(str))
+    matches = np.stack(
+        [np.char.startswith(names, element) for element in valid_elements]
+    )
 
-        candidates = [
-            element
-            for element in elements[method]
-            if name.capitalize().startswith(element)
-        ]
+    # Assign the unambiguous elements
+    unambiguous = matches.sum(axis=0) == 1
+    mol.element[unambiguous] = valid_elements[matches[:, unambiguous].argmax(axis=0)]
 
-        if len(candidates) == 1:
-            mol.element[i] = candidates[0]
-            continue
+    degrees = None
+    for i in np.flatnonzero(~unambiguous):
+
+        name = mol.name[i]
+        candidates = valid_elements[matches[:, i]].tolist()
 
         if candidates == ["C", "Cl"]:
 
             if len(mol.bonds) == 0:
                 raise RuntimeError("No chemical bonds found in the molecule")
 
-            # Create a molecular graph
-            import networkx as nx
-
-            graph = nx.Graph()
-            graph.add_edges_from(mol.bonds)
+            # Count the bonds of each atom (only once)
+            if degrees is None:
+                degrees = np.bincount(
+                    mol.bonds.ravel().astype(int), minlength=mol.numAtoms
+                )
 
-            if len(graph[i]) in (2, 3, 4):
+            if degrees[i] in (2, 3, 4):
                 mol.element[i] = "C"
                 continue
 
-            if len(graph[i]) == 1:
+            if degrees[i] == 1:
                 mol.element[i] = "Cl"
                 continue
 
@@ -73,19 +86,22 @@ def guessElements(mol, method):
     return mol
 
 
-def centreOfMass(mol):
-    return np.dot(mol.masses, mol.coords[:, :, mol.frame]) / np.sum(mol.masses)
+def centreOfMass(mol, total_mass=None):
+    if total_mass is None:
+        total_mass = np.sum(mol.masses)
+    return mol.masses @ np.ascontiguousarray(mol.coords[:, :, mol.frame]) / total_mass
 
 
 def getDipole(mol):
     """Calculate the dipole moment (in Debyes) of the molecule"""
     from scipy import constants as const
 
-    if mol.masses.sum() == 0:
+    total_mass = mol.masses.sum()
+    if total_mass == 0:
         logger.warning("No masses found in Molecule. Cannot calculate dipole.")
         return np.zeros(4)
     else:
-        coords = mol.coords[:, :, mol.frame] - centreOfMass(mol)
+        coords = mol.coords[:, :, mol.frame] - centreOfMass(mol, total_mass=total_mass)
 
     dipole = np.zeros(4)
     dipole[:3] = np.dot(mol.charge, coords)
@@ -97,33 +113,37 @@ def getDipole(mol):
     return dipole
 
 
-def _qm_method_name(qm):
-    basis = qm.basis
-    basis = re.sub("\+", "plus", basis)  # Replace '+' with 'plus'
-    basis = re.sub("\*", "star", basis)  # Replace '*' with 'star'
-    name = qm.theory + "-" + basis + "-" + qm.solvent
+@lru_cache(maxsize=64)
+def _qm_method_name_cached(theory, basis, solvent):
+    basis = _PLUS_RE.sub("plus", basis)  # Replace '+' with 'plus'
+    basis = _STAR_RE.sub("star", basis)  # Replace '*' with 'star'
+    name = theory + "-" + basis + "-" + solvent
     return name
 
 
+def _qm_method_name(qm):
+    return _qm_method_name_cached(qm.theory, qm.basis, qm.solvent)
+
+
 def getFixedChargeAtomIndices(mol, fix_charge):
-    fixed_atom_indices = []
-    for fixed_atom_name in fix_charge:
 
-        if fixed_atom_name not in mol.name:
+    names = set(mol.name)
+    for fixed_atom_name in fix_charge:
+        if fixed_atom_name not in names:
             raise ValueError(
                 "Atom {} is not found. Check --fix-charge arguments".format(
                     fixed_atom_name
                 )
             )
 
-        for aton_index in range(mol.numAtoms):
-            if mol.name[aton_index] == fixed_atom_name:
-                fixed_atom_indices.append(aton_index)
-                logger.info(
-                    "Charge of atom {} is fixed to {}".format(
-                        fixed_atom_name, mol.charge[aton_index]
-                    )
-                )
+    fixed_atom_indices = np.flatnonzero(np.isin(mol.name, list(fix_charge))).tolist()
+    for aton_index in fixed_atom_indices:
+        logger.info(
+            "Charge of atom {} is fixed to {}".format(
+                mol.name[aton_index], mol.charge[aton_index]
+            )
+        )
+
     return fixed_atom_indices
 
 
@@ -159,48 +179,132 @@ def minimize(mol, qm, outdir, min_type="qm", mm_minimizer=None):
     return mol
 
 
-def scanDihedrals(mol, ref, dihedrals, outdir, scan_type="qm", mm_minimizer=None):
+def _getRotamerCoords(mol, dihedral, angles):
+    """
+    Generate rotamer coordinates by setting a dihedral angle to each of the angles
+
+    It is equivalent to calling Molecule.setDihedral for each angle, but all the rotamers are
+    rotated at once.
+
+    Examples
+    --------
+    >>> import os
+    >>> from parameterize.home import home
+    >>> from moleculekit.molecule import Molecule
+    >>> molFile = os.path.join(home('test-param'), 'glycol.mol2')
+    >>> mol = Molecule(molFile)
+    >>> dihedral = [0, 1, 2, 3]
+    >>> angles = np.linspace(-np.pi, np.pi, num=6, endpoint=False)
+
+    >>> rotamer_coords = _getRotamerCoords(mol, dihedral, angles)
+    >>> rotamer_coords.shape
+    (10, 3, 6)
+
+    Each rotamer matches the coordinates from Molecule.setDihedral
+    >>> for iframe, angle in enumerate(angles):
+    ...     ref_mol = mol.copy()
+    ...     ref_mol.setDihedral(dihedral, angle, bonds=ref_mol.bonds)
+    ...     assert np.allclose(rotamer_coords[:, :, iframe], ref_mol.coords[:, :, 0], atol=1e-4)
+
+    The original molecule is not modified
+    >>> np.array_equal(mol.coords, Molecule(molFile).coords)
+    True
+
+    Dihedrals in rings cannot be rotated
+    >>> mol = Molecule(os.path.join(home('test-param'), 'benzamidine.mol2'))
+    >>> _getRotamerCoords(mol, [2, 0, 1, 3], angles)
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Loop detected in molecule. Cannot change dihedral
+    """
+    from moleculekit.dihedral import dihedralAngle
+    from moleculekit.util import rotationMatrix
+
+    i1, i2 = int(dihedral[1]), int(dihedral[2])
+
+    # Find the atoms on the i2 side of the i1--i2 bond
+    neighbors = [[] for _ in range(mol.numAtoms)]
+    for a, b in mol.bonds:
+        if {a, b} != {i1, i2}:
+            neighbors[a].append(b)
+            neighbors[b].append(a)
+    moving = {i2}
+    queue = [i2]
+    while queue:
+        for neighbor in neighbors[queue.pop()]:
+            if neighbor not in moving:
+                moving.add(neighbor)
+                queue.append(neighbor)
+    if i1 in moving:
+        raise RuntimeError("Loop detected in molecule. Cannot change dihedral")
+    moving = np.array(sorted(moving))
+
+    # Rotate the moving atoms around the i1--i2 bond for all the angles
+    coords = mol.coords[:, :, mol.frame]
+    centre = coords[i2]
+    current_angle = dihedralAngle(coords[list(dihedral)])
+    rotations = np.stack(
+        [rotationMatrix(centre - coords[i1], angle - current_angle) for angle in angles]
+    )
+
+    rotamer_coords = np.empty((mol.numAtoms, 3, len(angles)), dtype=coords.dtype)
+    rotamer_coords[:] = np.broadcast_to(coords[:, :, None], rotamer_coords.shape)
+    rotamer_coords[moving] = (
+        np.einsum("fij,nj->nif", rotations, coords[moving] - centre)
+        + centre[None, :, None]
+    )
+
+    return rotamer_coords
+
+
+def scanDihedrals(
+    mol, ref, dihedrals, outdir, scan_type="qm", mm_minimizer=None, max_workers=1
+):
     """
     Dihedrals passed as 4 atom indices
+
+    With scan_type="mm", up to max_workers rotamers are minimized concurrently. Each worker
+    thread creates its own OpenMM context, so keep it small.
     """
     num_rotamers = 36  # Number of rotamers for each dihedral to compute
 
     logger.info("Number of rotamers per dihedral angles: {}".format(num_rotamers))
 
-    # Create molecules with rotamers
-    # TODO factor out dihedral generation
+    # Generate rotamer coordinates
     logger.info("Generate rotamers for:")
-    molecules = []
+    angles = np.linspace(-np.pi, np.pi, num=num_rotamers, endpoint=False)
+    rotamer_coords = []
     for idihed, dihedral in enumerate(dihedrals):
         logger.info(
             "  {:2d}: {}".format(idihed + 1, "-".join(mol.name[list(dihedral)]))
         )
-
-        # Create a copy of molecule with "nrotamers" frames
-        new_mol = mol.copy()
-        new_mol.coords = np.tile(new_mol.coords, (1, 1, num_rotamers))
-        new_mol.box = np.zeros((3, new_mol.numFrames), dtype=np.float32)
-
-        # Set rotamer coordinates
-        angles = np.linspace(-np.pi, np.pi, num=num_rotamers, endpoint=False)
-        for frame, angle in enumerate(angles):
-            new_mol.frame = frame
-            new_mol.setDihedral(dihedral, angle, bonds=new_mol.bonds)
-
-        molecules.append(new_mol)
+        rotamer_coords.append(
+            _getRotamerCoords(mol, dihedral, angles).astype(np.float32, copy=False)
+        )
 
     # Minimize with MM if requested
     if scan_type == "mm":
         logger.info("Minimize rotamers with MM for:")
-        for idihed, (dihedral, molecule) in enumerate(zip(dihedrals, molecules)):
+        for idihed, (dihedral, coords) in enumerate(zip(dihedrals, rotamer_coords)):
             logger.info(
                 "  {:2d}: {}".format(idihed + 1, "-".join(mol.name[list(dihedral)]))
             )
-            for iframe in range(molecule.numFrames):
-                molecule.coords[:, :, iframe] = mm_minimizer.minimize(
-                    molecule.coords[:, :, iframe], restrained_dihedrals=[dihedral]
+
+            def minimizeFrame(frame_coords):
+                return mm_minimizer.minimize(
+                    frame_coords, restrained_dihedrals=[dihedral]
                 )
 
+            frames = [coords[:, :, iframe] for iframe in range(coords.shape[2])]
+            if max_workers > 1:
+                # The frames are independent, so minimize them concurrently
+                with ThreadPoolExecutor(max_workers) as executor:
+                    minimized_coords = list(executor.map(minimizeFrame, frames))
+            else:
+                minimized_coords = [minimizeFrame(frame) for frame in frames]
+            for iframe, frame_coords in enumerate(minimized_coords):
+                coords[:, :, iframe] = frame_coords
+
     # Create directories for QM data
     directories = []
     dihedral_directory = (
@@ -215,31 +319,34 @@ def scanDihedrals(mol, ref, dihedrals, outdir, scan_type="qm", mm_minimizer=None
         directories.append(directory)
 
     # Setup and submit QM calculations
-    for molecule, dihedral, directory in zip(molecules, dihedrals, directories):
-        ref.molecule = molecule
-        ref.esp_points = None
-        ref.optimize = scan_type == "qm"
-        ref.restrained_dihedrals = np.array([dihedral])
-        ref.directory = directory
-        ref.setup()
-        ref.submit()
+    # Each dihedral gets a shallow copy of the QM object (sharing the queue), so it keeps its
+    # own setup and does not have to be set up again before retrieving.
+    qms = []
+    for coords, dihedral, directory in zip(rotamer_coords, dihedrals, directories):
+
+        # Create a copy of molecule with the rotamers as frames
+        molecule = mol.copy()
+        molecule.coords = coords
+        molecule.box = np.zeros((3, molecule.numFrames), dtype=np.float32)
+
+        qm = copy(ref)
+        qm.molecule = molecule
+        qm.esp_points = None
+        qm.optimize = scan_type == "qm"
+        qm.restrained_dihedrals = np.array([dihedral])
+        qm.directory = directory
+        qm.setup()
+        qm.submit()
+        qms.append(qm)
 
     # Wait and retrieve QM calculation data
     scan_results = []
     logger.info("Compute rotamer energies for:")
-    for idihed, (molecule, dihedral, directory) in enumerate(
-        zip(molecules, dihedrals, directories)
-    ):
+    for idihed, (dihedral, qm) in enumerate(zip(dihedrals, qms)):
         logger.info(
             "  {:2d}: {}".format(idihed + 1, "-".join(mol.name[list(dihedral)]))
         )
-        ref.molecule = molecule
-        ref.esp_points = None
-        ref.optimize = scan_type == "qm"
-        ref.restrained_dihedrals = np.array([dihedral])
-        ref.directory = directory
-        ref.setup()  # QM object is reused, so it has to be properly set up before retrieving.
-        scan_results.append(ref.retrieve())
+        scan_results.append(qm.retrieve())
 
     return scan_results
 
@@ -305,6 +412,16 @@ def guessBondType(mol):
 
     mol = mol.copy()
 
+    # Skip antechamber, if the molecule has just H and O atoms with saturated valences
+    # (e.g. H2O, H2O2), as all the bonds are single
+    valences = {"H": 1, "O": 2}
+    if set(mol.element) <= set(valences):
+        degrees = np.bincount(mol.bonds.ravel().astype(int), minlength=mol.numAtoms)
+        expected = [valences[element] for element in mol.element]
+        if np.array_equal(degrees, expected):
+            mol.bondtype[:] = "1"
+            return mol
+
     with TemporaryDirectory() as tmpDir:
         old_name = os.path.join(tmpDir, "old.mol2")
         new_name = os.path.join(tmpDir, "new.mol2")
@@ -323,12 +440,17 @@ def guessBondType(mol):
             new_name,
         ]
 
-        with TemporaryFile() as stream:
-            if subprocess.call(cmd, cwd=tmpDir, stdout=stream, stderr=stream) != 0:
-                raise RuntimeError('"antechamber" failed')
-            stream.seek(0)
-            for line in stream.readlines():
-                logger.debug(line)
+        process = subprocess.run(
+            cmd,
+            cwd=tmpDir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        if process.returncode != 0:
+            raise RuntimeError('"antechamber" failed')
+        for line in process.stdout.splitlines():
+            logger.debug(line)
 
         mol.bondtype[:] = Molecule(new_name).bondtype
 
@@ -395,21 +517,29 @@ def makeAtomNamesUnique(mol):
 
     mol = mol.copy()
 
+    # Group atom indices by name, in order of the first occurrence
+    indices = {}
     for i, name in enumerate(mol.name):
-        while np.sum(name == mol.name) > 1:  # Check for identical names
-            j = np.flatnonzero(name == mol.name)[
-                1
-            ]  # Get the second identical name index
-            prefix, sufix = re.match("(.*?\D*)(\d*)$", mol.name[j]).groups()
-            sufix = 0 if sufix == "" else int(sufix)
-            while prefix + str(sufix) in mol.name:  # Search for a unique name
+        indices.setdefault(name, []).append(i)
+    used = set(indices)
+
+    for name, identical in indices.items():
+        if len(identical) == 1:
+            continue
+
+        # Keep the first atom name and rename the others
+        prefix, sufix = _NAME_RE.match(name).groups()
+        sufix = 0 if sufix == "" else int(sufix)
+        for j in identical[1:]:
+            while prefix + str(sufix) in used:  # Search for a unique name
                 sufix += 1
             mol.name[j] = prefix + str(sufix)
+            used.add(mol.name[j])
 
     return mol
 
 
-def detectChiralCenters(mol, atom_types=None):
+def detectChiralCenters(mol, atom_types=None, rdkit_mol=None):
     """
     Detect chiral centers
 
@@ -417,6 +547,11 @@ def detectChiralCenters(mol, atom_types=None):
     ----------
     mol: Molecule
         Molecule to detect chiral centers
+    atom_types: list of str
+        Atom types to set before converting the molecule to RDKit
+    rdkit_mol: rdkit.Chem.Mol
+        Prebuilt RDKit molecule corresponding to "mol". If given, only its coordinates are
+        updated from "mol", avoiding a new conversion.
 
     Return
     ------
@@ -442,11 +577,17 @@ def detectChiralCenters(mol, atom_types=None):
     >>> mol = Molecule(molFile)
     >>> detectChiralCenters(mol, atom_types=mol.atomtype)
     [(0, 'R'), (2, 'S'), (4, 'R')]
+
+    >>> from moleculekit.rdkitintegration import _convertMoleculeToRDKitMol
+    >>> rdkit_mol = _convertMoleculeToRDKitMol(mol)
+    >>> detectChiralCenters(mol, rdkit_mol=rdkit_mol)
+    [(0, 'R'), (2, 'S'), (4, 'R')]
     """
 
     from moleculekit.molecule import Molecule
     from moleculekit.rdkitintegration import _convertMoleculeToRDKitMol
     from rdkit.Chem import AssignAtomChiralTagsFromStructure, FindMolChiralCenters
+    from rdkit.Geometry import Point3D
 
     if not isinstance(mol, Molecule):
         raise TypeError('"mol" has to be instance of {}'.format(Molecule))
@@ -455,19 +596,86 @@ def detectChiralCenters(mol, atom_types=None):
             '"mol" can have just one frame, but it has {}'.format(mol.numFrames)
         )
 
-    # Set atom types, overwise rdkit refuse to read some MOL2 files
-    htmd_mol = mol.copy()
-    if atom_types is not None:
-        htmd_mol.atomtype = atom_types
+    if rdkit_mol is None:
+        # Set atom types, overwise rdkit refuse to read some MOL2 files
+        htmd_mol = mol.copy()
+        if atom_types is not None:
+            htmd_mol.atomtype = atom_types
+        rdkit_mol = _convertMoleculeToRDKitMol(htmd_mol)
+    else:
+        # Reuse the RDKit molecule and just update its coordinates
+        conformer = rdkit_mol.GetConformer()
+        for i, position in enumerate(mol.coords[:, :, 0].astype(float)):
+            conformer.SetAtomPosition(i, Point3D(*position))
 
     # Detect chiral centers and assign their labels
-    rdkit_mol = _convertMoleculeToRDKitMol(htmd_mol)
     AssignAtomChiralTagsFromStructure(rdkit_mol)
     chiral_centers = FindMolChiralCenters(rdkit_mol, includeUnassigned=True)
 
     return chiral_centers
 
 
+def _getChiralQuads(mol, chiral_centers):
+    """
+    Get index quadruplets of chiral centers and their 3 heaviest neighbours
+
+    Return None, if any of the chiral centers has less than 3 neighbours.
+    """
+
+    neighbors = [[] for _ in range(mol.numAtoms)]
+    for a, b in mol.bonds:
+        neighbors[a].append(b)
+        neighbors[b].append(a)
+
+    quads = []
+    for centre, _ in chiral_centers:
+        heaviest = sorted(neighbors[centre], key=lambda i: -mol.masses[i])[:3]
+        if len(heaviest) < 3:
+            return None
+        quads.append([centre, *heaviest])
+
+    return np.array(quads, dtype=int).reshape((-1, 4))
+
+
+def _getChiralVolumeSigns(coords, quads):
+    """
+    Get signs of the volumes spanned by the chiral centers and their neighbours
+
+    Examples
+    --------
+    >>> from parameterize.home import home
+    >>> from moleculekit.molecule import Molecule
+    >>> molFile = os.path.join(home('test-param'), 'fluorchlorcyclopronol.mol2')
+    >>> mol = Molecule(molFile)
+    >>> quads = _getChiralQuads(mol, [(0, 'R'), (2, 'S'), (4, 'R')])
+    >>> quads.shape
+    (3, 4)
+
+    >>> signs = _getChiralVolumeSigns(mol.coords[:, :, 0], quads)
+    >>> signs
+    array([-1., -1.,  1.], dtype=float32)
+
+    A rigid rotation preserves the signs
+    >>> from moleculekit.util import rotationMatrix
+    >>> rotation = rotationMatrix([1, 2, 3], 1.5)
+    >>> rotated = mol.coords[:, :, 0] @ rotation.T
+    >>> np.array_equal(_getChiralVolumeSigns(rotated, quads), signs)
+    True
+
+    A mirror image inverts all the chiral centers
+    >>> mirrored = mol.coords[:, :, 0] * [-1, 1, 1]
+    >>> np.array_equal(_getChiralVolumeSigns(mirrored, quads), -signs)
+    True
+
+    Centers with less than 3 neighbours cannot be checked
+    >>> _getChiralQuads(mol, [(5, '?')]) is None
+    True
+    """
+
+    vectors = coords[quads[:, 1:]] - coords[quads[:, :1]]
+    return np.sign(np.linalg.det(vectors))
+
+
 def filterQMResults(all_results, mol=None):
     """
     Filter QM results
@@ -508,16 +716,38 @@ def filterQMResults(all_results, mol=None):
     >>> results[15].energy = 17
     >>> len(filterQMResults(all_results)[0])
     17
+
+    Results with inverted chiral centers are removed, if a molecule is given
+    >>> from parameterize.home import home
+    >>> from moleculekit.molecule import Molecule
+    >>> molFile = os.path.join(home('test-param'), 'fluorchlorcyclopronol.mol2')
+    >>> mol = Molecule(molFile)
+    >>> unchanged, inverted = QMResult(), QMResult()
+    >>> unchanged.energy = inverted.energy = 0
+    >>> unchanged.coords = mol.coords.copy()
+    >>> inverted.coords = mol.coords * np.array([-1, 1, 1])[:, None]
+    >>> valid_results = filterQMResults([[unchanged, inverted]], mol=mol)
+    >>> len(valid_results[0])
+    1
+    >>> valid_results[0][0] is unchanged
+    True
     """
 
     from parameterize.qm import QMResult
     from moleculekit.molecule import Molecule
+    from moleculekit.rdkitintegration import _convertMoleculeToRDKitMol
 
     if mol:
         if not isinstance(mol, Molecule):
             raise TypeError('"mol" has to be instance of {}'.format(Molecule))
         initial_chiral_centers = detectChiralCenters(mol)
         mol = mol.copy()
+        rdkit_mol = _convertMoleculeToRDKitMol(mol)  # Reused for all the results
+
+        # Chiral centers can only change, if their signed volumes change
+        chiral_quads = _getChiralQuads(mol, initial_chiral_centers)
+        if chiral_quads is not None:
+            initial_signs = _getChiralVolumeSigns(mol.coords[:, :, 0], chiral_quads)
 
     all_valid_results = []
     for results in all_results:
@@ -536,32 +766,43 @@ def filterQMResults(all_results, mol=None):
 
             # Remove results with wrong chiral centers
             if mol:
-                mol.coords = result.coords
-                chiral_centers = detectChiralCenters(mol)
-                if initial_chiral_centers != chiral_centers:
-                    logger.warning(
-                        "Rotamer is removed due to a change of chiral centers: "
-                        "{} --> {}".format(initial_chiral_centers, chiral_centers)
-                    )
-                    continue
+                if chiral_quads is not None:
+                    signs = _getChiralVolumeSigns(result.coords[:, :, 0], chiral_quads)
+                    check_chirality = np.any(signs != initial_signs)
+                else:
+                    check_chirality = True
+
+                # Verify with RDKit only the suspicious results
+                if check_chirality:
+                    mol.coords = result.coords
+                    chiral_centers = detectChiralCenters(mol, rdkit_mol=rdkit_mol)
+                    if initial_chiral_centers != chiral_centers:
+                        logger.warning(
+                            "Rotamer is removed due to a change of chiral centers: "
+                            "{} --> {}".format(initial_chiral_centers, chiral_centers)
+                        )
+                        continue
 
             valid_results.append(result)
 
         # Remove results with too high energies (>20 kcal/mol above the minimum)
         if len(valid_results) > 0:
-            minimum_energy = np.min([result.energy for result in valid_results])
+            energies = np.fromiter(
+                (result.energy for result in valid_results),
+                dtype=np.float64,
+                count=len(valid_results),
+            )
+            relative_energies = energies - energies.min()
+            is_low = relative_energies < 20  # kcal/mol
 
-            new_results = []
-            for result in valid_results:
-                relative_energy = result.energy - minimum_energy
-                if relative_energy < 20:  # kcal/mol
-                    new_results.append(result)
-                else:
-                    logger.warning(
-                        "Rotamer is removed due to high energy: "
-                        "{} kcal/mol above minimum".format(relative_energy)
-                    )
-            valid_results = new_results
+            for relative_energy in relative_energies[~is_low]:
+                logger.warning(
+                    "Rotamer is removed due to high energy: "
+                    "{} kcal/mol above minimum".format(relative_energy)
+                )
+            valid_results = [
+                result for result, low in zip(valid_results, is_low) if low
+            ]
 
         all_valid_results.append(valid_results)
 
@@ -0,0 +1,218 @@
+# (c) 2015-2018 Acellera Ltd http://www.acellera.com
+# All Rights Reserved
+# Distributed under HTMD Software License Agreement
+# No redistribution in whole or part
+#
+import os
+import threading
+from collections import OrderedDict
+from subprocess import call
+from tempfile import TemporaryDirectory
+
+import numba
+import numpy as np
+from scipy.optimize import minimize
+
+try:
+    from simtk.openmm import app
+except ImportError:
+    app = None
+
+from parameterize.parameterization.writers import writeFRCMOD, getAtomTypeMapping
+
+# Conversion factors between the units of parameterize (A, kcal/mol) and OpenMM (nm, kJ/mol)
+_ANGSTROM_TO_NM = 0.1
+_KCAL_TO_KJ = 4.184
+
+_RESTRAINT_CONSTANT = 10000  # kcal/mol, the force constant of dihedral restraints
+
+
+@numba.njit(cache=True)
+def _dihedralAngleGradient(coords, i0, i1, i2, i3, grad):
+    """
+    Compute a dihedral angle and its gradient with respect to the coordinates of its 4 atoms
+
+    The angle follows the convention of moleculekit.dihedral.dihedralAngle. The gradient is
+    written to grad, a (4, 3) array. Everything is computed with scalars, so no temporary arrays
+    are allocated.
+    """
+
+    b0x = coords[i1, 0] - coords[i0, 0]
+    b0y = coords[i1, 1] - coords[i0, 1]
+    b0z = coords[i1, 2] - coords[i0, 2]
+    b1x = coords[i2, 0] - coords[i1, 0]
+    b1y = coords[i2, 1] - coords[i1, 1]
+    b1z = coords[i2, 2] - coords[i1, 2]
+    b2x = coords[i3, 0] - coords[i2, 0]
+    b2y = coords[i3, 1] - coords[i2, 1]
+    b2z = coords[i3, 2] - coords[i2, 2]
+
+    # n0 = b0 x b1 and n1 = b1 x b2
+    n0x = b0y * b1z - b0z * b1y
+    n0y = b0z * b1x - b0x * b1z
+    n0z = b0x * b1y - b0y * b1x
+    n1x = b1y * b2z - b1z * b2y
+    n1y = b1z * b2x - b1x * b2z
+    n1z = b1x * b2y - b1y * b2x
+
+    b1_norm2 = b1x * b1x + b1y * b1y + b1z * b1z
+    b1_norm = np.sqrt(b1_norm2)
+
+    angle = np.arctan2(
+        (b0x * n1x + b0y * n1y + b0z * n1z) * b1_norm,
+        n0x * n1x + n0y * n1y + n0z * n1z,
+    )
+
+    g0 = -b1_norm / (n0x * n0x + n0y * n0y + n0z * n0z)
+    g3 = b1_norm / (n1x * n1x + n1y * n1y + n1z * n1z)
+    f0 = (b0x * b1x + b0y * b1y + b0z * b1z) / b1_norm2
+    f2 = (b2x * b1x + b2y * b1y + b2z * b1z) / b1_norm2
+
+    grad[0, 0] = g0 * n0x
+    grad[0, 1] = g0 * n0y
+    grad[0, 2] = g0 * n0z
+    grad[3, 0] = g3 * n1x
+    grad[3, 1] = g3 * n1y
+    grad[3, 2] = g3 * n1z
+    for k in range(3):
+        grad[1, k] = f2 * grad[3, k] - (f0 + 1) * grad[0, k]
+        grad[2, k] = f0 * grad[0, k] - (f2 + 1) * grad[3, k]
+
+    return angle
+
+
+@numba.njit(cache=True)
+def _getDihedralRestraint(coords, dihedrals, ref_angles, k):
+    """
+    Compute the energy and gradient of k*(1 - cos(angle - ref_angle)) restraints on dihedral angles
+
+    The dihedrals are given as a (ndihedrals, 4) integer array.
+    """
+
+    energy = 0.0
+    grad = np.zeros(coords.shape)
+    angle_grad = np.empty((4, 3))
+    for i in range(dihedrals.shape[0]):
+        i0, i1, i2, i3 = dihedrals[i]
+        angle = _dihedralAngleGradient(coords, i0, i1, i2, i3, angle_grad)
+        energy += k * (1 - np.cos(angle - ref_angles[i]))
+        factor = k * np.sin(angle - ref_angles[i])
+        for j in range(4):
+            for dim in range(3):
+                grad[dihedrals[i, j], dim] += factor * angle_grad[j, dim]
+
+    return energy, grad
+
+
+# LRU cache of the prmtop objects, so tleap runs once for each molecule topology and parameters.
+# It is bounded, as the parameters change at every iteration of a fitting.
+_PRMTOP_CACHE_SIZE = 16
+_prmtop_cache = OrderedDict()
+_prmtop_cache_lock = threading.Lock()
+
+
+def _getPrmtop(mol, prm):
+    """
+    Build an OpenMM AmberPrmtopFile of the molecule with tleap
+
+    The last prmtop objects are cached, so repeated builds for the same molecule do not run tleap.
+    """
+    if app is None:
+        raise ImportError(
+            "Building a prmtop requires OpenMM. Install it with: conda install openmm"
+        )
+
+    with TemporaryDirectory() as tmpDir:
+        frcFile = os.path.join(tmpDir, "mol.frcmod")
+        mapping = getAtomTypeMapping(prm)
+        writeFRCMOD(mol, prm, frcFile, typemap=mapping)
+        mol2 = mol.copy()
+        mol2.atomtype[:] = [mapping.get(atomtype) for atomtype in mol2.atomtype]
+
+        # The prmtop does not depend on the coordinates, so they are not part of the key
+        with open(frcFile) as fd:
+            key = (
+                fd.read(),
+                repr(
+                    [
+                        getattr(mol2, field).tolist()
+                        for field in (
+                            "name",
+                            "element",
+                            "atomtype",
+                            "charge",
+                            "resname",
+                            "resid",
+                            "bonds",
+                            "bondtype",
+                        )
+                    ]
+                ),
+            )
+        with _prmtop_cache_lock:
+            if key in _prmtop_cache:
+                _prmtop_cache.move_to_end(key)
+                return _prmtop_cache[key]
+
+        molFile = os.path.join(tmpDir, "mol.mol2")
+        mol2.write(molFile)
+
+        with open(os.path.join(tmpDir, "tleap.inp"), "w") as file:
+            file.writelines(
+                (
+                    "loadAmberParams %s\n" % frcFile,
+                    "MOL = loadMol2 %s\n" % molFile,
+                    "saveAmberParm MOL mol.prmtop mol.inpcrd\n",
+                    "quit",
+                )
+            )
+
+        with open(os.path.join(tmpDir, "tleap.out"), "w") as out:
+            call(("tleap", "-f", "tleap.inp"), cwd=tmpDir, stdout=out)
+
+        prmtop = app.AmberPrmtopFile(os.path.join(tmpDir, "mol.prmtop"))
+
+    with _prmtop_cache_lock:
+        _prmtop_cache[key] = prmtop
+        if len(_prmtop_cache) > _PRMTOP_CACHE_SIZE:
+            _prmtop_cache.popitem(last=False)
+
+    return prmtop
+
+
+def _minimizeContext(context, x0, force_tolerance):
+    """
+    Minimize the energy of an OpenMM context with L-BFGS-B
+
+    The coordinates are in A and the tolerance is on the max force component in kcal/mol/A. If
+    L-BFGS-B does not reach the tolerance, it is restarted once from its result. Returns the best
+    result and its max force component.
+    """
+    natoms = x0.size // 3
+    positions = np.empty((natoms, 3))
+
+    def goalFunc(x):
+        # Work on the raw values in OpenMM units (nm, kJ/mol) to skip simtk.unit
+        np.multiply(x.reshape((natoms, 3)), _ANGSTROM_TO_NM, out=positions)
+        context.setPositions(positions)
+        state = context.getState(getEnergy=True, getForces=True)
+        energy = state.getPotentialEnergy()._value / _KCAL_TO_KJ
+        forces = state.getForces(asNumpy=True)._value
+        # The gradient is not preallocated, as SciPy keeps references to it
+        grad = forces.reshape(-1) * (-_ANGSTROM_TO_NM / _KCAL_TO_KJ)
+        return energy, grad
+
+    options = {"ftol": 0, "gtol": force_tolerance}
+    result = minimize(goalFunc, x0, method="L-BFGS-B", jac=True, options=options)
+    max_force = np.abs(result.jac).max()
+
+    if max_force > force_tolerance:
+        # Try to continue minimization by restarting the minimizer
+        restarted_result = minimize(
+            goalFunc, result.x, method="L-BFGS-B", jac=True, options=options
+        )
+        restarted_max_force = np.abs(restarted_result.jac).max()
+        if restarted_max_force < max_force:
+            result, max_force = restarted_result, restarted_max_force
+
+    return result, max_force
@@ -57,6 +57,50 @@ class QMResult:
         self.charge = None
 
 
+def _hasResult(directory):
+    """
+    Check if a QMResult has been saved in the directory, including the legacy pickle format
+    """
+    return any(
+        os.path.exists(os.path.join(directory, name))
+        for name in ("data.npz", "data.pkl")
+    )
+
+
+def _saveResult(directory, result):
+    """
+    Save a QMResult to data.npz in the directory
+
+    Only the attributes which are set are saved, so the file is read back without pickle.
+    """
+    arrays = {
+        name: np.asarray(value)
+        for name, value in vars(result).items()
+        if value is not None
+    }
+    np.savez_compressed(os.path.join(directory, "data.npz"), **arrays)
+
+
+def _loadResult(directory):
+    """
+    Load a QMResult from data.npz in the directory, or from data.pkl of older versions
+    """
+    npzFile = os.path.join(directory, "data.npz")
+    if not os.path.exists(npzFile):
+        import pickle
+
+        with open(os.path.join(directory, "data.pkl"), "rb") as fd:
+            return pickle.load(fd)
+
+    result = QMResult()
+    with np.load(npzFile) as data:
+        for name in data.files:
+            value = data[name]
+            setattr(result, name, value.item() if value.ndim == 0 else value)
+
+    return result
+
+
 class QMBase(ABC, ProtocolInterface):
     """
     Abstract base class to set up and run QM calculations
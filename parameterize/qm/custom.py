@@ -5,18 +5,38 @@
 #
 import os
 import time
-import pickle
 import logging
 import abc
+import threading
+from copy import deepcopy
 
 import numpy as np
-import nlopt
+from scipy.optimize import minimize
+
+try:
+    from simtk import openmm
+    from simtk.openmm import app
+except ImportError:
+    openmm = None
+    app = None
 
 from moleculekit.dihedral import dihedralAngle
-from parameterize.qm.base import QMBase, QMResult
+from parameterize.qm._mm import (
+    _getDihedralRestraint,
+    _getPrmtop,
+    _minimizeContext,
+    _KCAL_TO_KJ,
+    _RESTRAINT_CONSTANT,
+)
+from parameterize.qm.base import (
+    QMBase,
+    QMResult,
+    _hasResult,
+    _loadResult,
+    _saveResult,
+)
 from protocolinterface import val
 
-
 logger = logging.getLogger(__name__)
 
 
@@ -59,137 +79,96 @@ class OMMMinimizer(Minimizer):
         """
         super().__init__()
 
-        import simtk.openmm as mm
+        if openmm is None:
+            raise ImportError(
+                "OMMMinimizer requires OpenMM. Install it with: conda install openmm"
+            )
 
         if buildff == "AMBER":
             self.structure = self._get_prmtop(mol, prm)
 
         self.system = self.structure.createSystem()
-        self.platform = mm.Platform.getPlatformByName(platform)
+        self.platform = openmm.Platform.getPlatformByName(platform)
         self.platprop = (
             {"CudaPrecision": "mixed", "CudaDeviceIndex": device}
             if platform == "CUDA"
             else None
         )
+        self._local = threading.local()
 
     def _get_prmtop(self, mol, prm):
-        from parameterize.parameterization.writers import (
-            writeFRCMOD,
-            getAtomTypeMapping,
-        )
-        from tempfile import TemporaryDirectory
-        from subprocess import call
-        from simtk.openmm import app
-
-        with TemporaryDirectory() as tmpDir:
-            frcFile = os.path.join(tmpDir, "mol.frcmod")
-            mapping = getAtomTypeMapping(prm)
-            writeFRCMOD(mol, prm, frcFile, typemap=mapping)
-            mol2 = mol.copy()
-            mol2.atomtype[:] = np.vectorize(mapping.get)(mol2.atomtype)
-            molFile = os.path.join(tmpDir, "mol.mol2")
-            mol2.write(molFile)
-
-            with open(os.path.join(tmpDir, "tleap.inp"), "w") as file:
-                file.writelines(
-                    (
-                        "loadAmberParams %s\n" % frcFile,
-                        "MOL = loadMol2 %s\n" % molFile,
-                        "saveAmberParm MOL mol.prmtop mol.inpcrd\n",
-                        "quit",
-                    )
-                )
-
-            with open(os.path.join(tmpDir, "tleap.out"), "w") as out:
-                call(("tleap", "-f", "tleap.inp"), cwd=tmpDir, stdout=out)
+        return _getPrmtop(mol, prm)
 
-            prmtop = app.AmberPrmtopFile(os.path.join(tmpDir, "mol.prmtop"))
+    def _getSimulation(self, restrained_dihedrals):
+        """
+        Get a Simulation with restraints on the given dihedrals
 
-        return prmtop
+        The simulations are cached per thread, so concurrent minimizations do not interfere. Only
+        the unrestrained simulation and the last restrained one are kept, as a scan minimizes all
+        the rotamers of a dihedral before moving to the next one.
+        """
+        simulations = getattr(self._local, "simulations", None)
+        if simulations is None:
+            simulations = self._local.simulations = {}
+
+        if restrained_dihedrals not in simulations:
+            system = self.system
+            if restrained_dihedrals:
+                # Release the simulation of the previous restrained dihedrals
+                for key in [key for key in simulations if key]:
+                    del simulations[key]
+
+                # The restraints go to the last force of a copy of the system
+                system = deepcopy(self.system)
+                f = openmm.PeriodicTorsionForce()
+                for dihedral in restrained_dihedrals:
+                    f.addTorsion(*dihedral, 1, 0.0, 0.0)
+                system.addForce(f)
+
+            integrator = openmm.LangevinIntegrator(0, 0, 0)
+            simulations[restrained_dihedrals] = app.Simulation(
+                self.structure.topology,
+                system,
+                integrator,
+                self.platform,
+                self.platprop,
+            )
 
-    def minimize(self, coords, restrained_dihedrals=None, maxeval=None):
-        from simtk import unit
-        from simtk.openmm import app, PeriodicTorsionForce
-        import simtk.openmm as mm
-        from scipy.optimize import minimize
+        return simulations[restrained_dihedrals]
 
-        forceidx = []
+    def _minimizeFrom(self, x0, restrained_dihedrals, ref_angles, force_tolerance):
+        """
+        Minimize from the given coordinates with the simulation of the current thread
+        """
+        sim = self._getSimulation(restrained_dihedrals)
         if restrained_dihedrals:
-            f = PeriodicTorsionForce()
-
-            for dihedral in restrained_dihedrals:
-                theta0 = dihedralAngle(coords[dihedral])
-                f.addTorsion(
-                    *tuple(map(int, dihedral)),
-                    periodicity=1,
-                    phase=theta0,
-                    k=-10000 * unit.kilocalories_per_mole
+            f = sim.system.getForce(sim.system.getNumForces() - 1)
+            for i, dihedral in enumerate(restrained_dihedrals):
+                f.setTorsionParameters(
+                    i, *dihedral, 1, ref_angles[i], -_RESTRAINT_CONSTANT * _KCAL_TO_KJ
                 )
+            f.updateParametersInContext(sim.context)
 
-            fidx = self.system.addForce(f)
-            forceidx.append(fidx)
+        return _minimizeContext(sim.context, x0, force_tolerance)
 
+    def minimize(self, coords, restrained_dihedrals=None, maxeval=None):
         if coords.ndim == 3:
             coords = coords[:, :, 0]
 
-        natoms = coords.shape[0]
-
-        integrator = mm.LangevinIntegrator(0, 0, 0)
-        sim = app.Simulation(
-            self.structure.topology,
-            self.system,
-            integrator,
-            self.platform,
-            self.platprop,
+        if restrained_dihedrals is None:
+            restrained_dihedrals = []
+        restrained_dihedrals = tuple(
+            tuple(map(int, dihedral)) for dihedral in restrained_dihedrals
         )
+        ref_angles = [
+            dihedralAngle(coords[list(dihedral)]) for dihedral in restrained_dihedrals
+        ]
 
-        def goalFunc(x):
-            sim.context.setPositions(x.reshape((natoms, 3)) * unit.angstrom)
-            state = sim.context.getState(getEnergy=True, getForces=True)
-            energy = state.getPotentialEnergy().value_in_unit(
-                unit.kilocalories_per_mole
-            )
-            forces = state.getForces(asNumpy=True).value_in_unit(
-                unit.kilocalories_per_mole / unit.angstrom
-            )
-            grad = -forces.reshape(-1)
-            return energy, grad
-
+        natoms = coords.shape[0]
         force_tolerance = 0.1  # kcal/mol/A
-        max_attempts = 50
-        best_result = None
-        best_force = np.inf
-        for i in range(max_attempts):
-            result = minimize(
-                goalFunc,
-                coords.reshape(-1),
-                method="L-BFGS-B",
-                jac=True,
-                options={"ftol": 0, "gtol": force_tolerance},
-            )
-            max_force = np.abs(result.jac).max()
-
-            if max_force < best_force:
-                best_force = max_force
-                best_result = result
-
-            if max_force > force_tolerance:
-                # Try to continue minimization by restarting the minimizer
-                result = minimize(
-                    goalFunc,
-                    result.x,
-                    method="L-BFGS-B",
-                    jac=True,
-                    options={"ftol": 0, "gtol": force_tolerance},
-                )
-                max_force = np.abs(result.jac).max()
-
-            if max_force < best_force:
-                best_force = max_force
-                best_result = result
-
-            if max_force <= force_tolerance:
-                break
+        best_result, best_force = self._minimizeFrom(
+            coords.reshape(-1), restrained_dihedrals, ref_angles, force_tolerance
+        )
 
         if best_force > force_tolerance:
             logger.warning(
@@ -200,44 +179,89 @@ class OMMMinimizer(Minimizer):
 
         minimized_coords = best_result.x.reshape((natoms, 3)).copy()
 
-        if restrained_dihedrals:
-            for fi in forceidx[::-1]:
-                self.system.removeForce(fi)
-
         return minimized_coords
 
 
 class CustomEnergyBasedMinimizer(Minimizer):
-    def __init__(self, mol, calculator):
+    def __init__(self, mol, calculator, dtype=np.float64):
+        """A minimizer based on a custom energy calculator
+
+        The calculator has to return energies and forces. The minimization is done with L-BFGS-B
+        and the dihedral angles are restrained with k*(1 - cos(angle - ref_angle)) potentials.
+
+        Parameters
+        ----------
+        mol : Molecule
+            The Molecule object containing the elements of the molecule
+        calculator : Calculator
+            The calculator of energies and forces
+        dtype : numpy.dtype
+            The precision of the coordinates passed to the calculator. Use np.float32 for
+            single-precision calculators (e.g. AAICalculator) to skip their conversions. L-BFGS-B
+            always works in double precision.
+        """
         super().__init__()
-        self.opt = nlopt.opt(nlopt.LN_COBYLA, mol.coords.size)
+        self.calculator = calculator
+        self.elements = mol.element
+        self.dtype = dtype
 
-        def objective(x, _):
-            return float(
-                calculator.calculate(
-                    x.reshape((-1, 3, 1)), mol.element, units="kcalmol"
-                )[0]
-            )
+    def _energy_and_grad(self, coords):
+        """
+        Compute the energy and its gradient with a single calculator call
 
-        self.opt.set_min_objective(objective)
+        Parameters
+        ----------
+        coords : numpy.ndarray
+            Coordinates of the atoms with shape (natoms, 3) in A
+
+        Returns
+        -------
+        energy : float
+            The energy in kcal/mol
+        grad : numpy.ndarray
+            The gradient of the energy with shape (natoms, 3) in kcal/mol/A
+        """
+        coords = coords.astype(self.dtype, copy=False)
+        energies, forces = self.calculator.calculate(
+            coords[:, :, None], self.elements, units="kcalmol", return_forces=True
+        )
+        energy = float(np.ravel(energies)[0])
+        grad = -np.asarray(forces, dtype=np.float64).reshape(coords.shape)
+
+        return energy, grad
 
     def minimize(self, coords, restrained_dihedrals):
+        if coords.ndim == 3:
+            coords = coords[:, :, 0]
+
+        dihedrals = np.zeros((0, 4), dtype=np.int64)
         if restrained_dihedrals is not None:
-            for dihedral in restrained_dihedrals:
-                indices = dihedral.copy()
-                ref_angle = dihedralAngle(coords[indices, :, 0])
+            dihedrals = np.array(restrained_dihedrals, dtype=np.int64).reshape((-1, 4))
+        ref_angles = np.array(
+            [dihedralAngle(coords[dihedral]) for dihedral in dihedrals]
+        )
+
+        def goalFunc(x):
+            x = x.reshape((-1, 3))
+            energy, grad = self._energy_and_grad(x)
+            if len(dihedrals) > 0:
+                restraint_energy, restraint_grad = _getDihedralRestraint(
+                    x, dihedrals, ref_angles, _RESTRAINT_CONSTANT
+                )
+                energy += restraint_energy
+                grad += restraint_grad
 
-                def constraint(x, _):
-                    coords = x.reshape((-1, 3))
-                    angle = dihedralAngle(coords[indices])
-                    return np.sin(0.5 * (angle - ref_angle))
+            return energy, grad.reshape(-1)
 
-                self.opt.add_equality_constraint(constraint)
+        result = minimize(
+            goalFunc,
+            coords.reshape(-1).astype(np.float64),
+            method="L-BFGS-B",
+            jac=True,
+            options={"gtol": 1e-3},
+        )
 
-        self.opt.set_xtol_abs(1e-3)  # Similar to Psi4 default
-        self.opt.set_maxeval(1000 * self.opt.get_dimension())
-        self.opt.set_initial_step(1e-3)
-        return self.opt.optimize(coords.ravel()).reshape((-1, 3, 1))
+        return result.x.reshape((-1, 3, 1))
 
 
 class CustomQM(QMBase):
@@ -353,43 +377,56 @@ class CustomQM(QMBase):
         pass
 
     def _completed(self, directory):
-        return os.path.exists(os.path.join(directory, "data.pkl"))
+        return _hasResult(directory)
 
     def retrieve(self):
 
-        results = []
+        results = [None] * self.molecule.numFrames
+        iframes = []
         for iframe in range(self.molecule.numFrames):
-            self.molecule.frame = iframe
-
             directory = os.path.join(self.directory, "%05d" % iframe)
             os.makedirs(directory, exist_ok=True)
-            pickleFile = os.path.join(directory, "data.pkl")
-            molFile = os.path.join(directory, "mol.mol2")
 
             if self._completed(directory):
-                with open(pickleFile, "rb") as fd:
-                    result = pickle.load(fd)
-                logger.info("Loading data from %s" % pickleFile)
-
+                results[iframe] = _loadResult(directory)
+                logger.info("Loading data from %s" % directory)
             else:
-                start = time.clock()
+                iframes.append(iframe)
+
+        if len(iframes) == 0:
+            return results
+
+        def save(iframe, result):
+            if self._verbose:
+                logger.info(
+                    "Custom calculator calculation time: %f s" % result.calculator_time
+                )
+            _saveResult(os.path.join(self.directory, "%05d" % iframe), result)
+            results[iframe] = result
+
+        if self.optimize:
+            if self.minimizer is None:
+                self.minimizer = CustomEnergyBasedMinimizer(
+                    self.molecule, self.calculator
+                )
+            molecule_copy = self.molecule.copy()
+
+            # Minimize the remaining frames one by one and save each of them, so an interrupted
+            # run can be resumed
+            for iframe in iframes:
+                directory = os.path.join(self.directory, "%05d" % iframe)
+                start = time.perf_counter()
 
                 result = QMResult()
                 result.errored = False
-                result.coords = self.molecule.coords[:, :, iframe : iframe + 1].copy()
-
-                if self.optimize:
-                    if self.minimizer is None:
-                        self.minimizer = CustomEnergyBasedMinimizer(
-                            self.molecule, self.calculator
-                        )
-                    result.coords = self.minimizer.minimize(
-                        result.coords, self.restrained_dihedrals
-                    ).reshape((-1, 3, 1))
-                    mol = self.molecule.copy()
-                    mol.frame = 0
-                    mol.coords = result.coords
-                    mol.write(molFile)
+                # The minimizers do not modify the coordinates, so a view is enough
+                result.coords = self.minimizer.minimize(
+                    self.molecule.coords[:, :, iframe : iframe + 1],
+                    self.restrained_dihedrals,
+                ).reshape((-1, 3, 1))
+                molecule_copy.frame = iframe
+                molecule_copy.coords[:, :, iframe] = result.coords[:, :, 0]
+                molecule_copy.write(os.path.join(directory, "mol.mol2"))
 
                 result.energy = float(
                     self.calculator.calculate(
@@ -401,18 +438,26 @@ class CustomQM(QMBase):
                 # if self.optimize:
                 #    assert opt.last_optimum_value() == result.energy # A self-consistency test
 
-                finish = time.clock()
-                result.calculator_time = finish - start
-                if self._verbose:
-                    logger.info(
-                        "Custom calculator calculation time: %f s"
-                        % result.calculator_time
-                    )
+                result.calculator_time = time.perf_counter() - start
+                save(iframe, result)
 
-                with open(pickleFile, "wb") as fd:
-                    pickle.dump(result, fd)
+        else:
+            # Compute the energies of all the remaining frames with one calculator call
+            start = time.perf_counter()
+            coords = self.molecule.coords[:, :, iframes]
+            energies = self.calculator.calculate(
+                coords, self.molecule.element, units="kcalmol"
+            )
+            calculator_time = (time.perf_counter() - start) / len(iframes)
 
-            results.append(result)
+            for i, iframe in enumerate(iframes):
+                result = QMResult()
+                result.errored = False
+                result.coords = coords[:, :, i : i + 1].copy()
+                result.energy = float(energies[i])
+                result.dipole = [0, 0, 0]
+                result.calculator_time = calculator_time
+                save(iframe, result)
 
         return results
 
@@ -4,26 +4,260 @@
 # No redistribution in whole or part
 #
 import os
-import pickle
 import logging
-from subprocess import call
-from tempfile import TemporaryDirectory
+from multiprocessing import Pool
 
 import numpy as np
 from scipy import constants as const
 from scipy.spatial.distance import cdist
-import nlopt
-from simtk import unit
-from simtk import openmm
-from simtk.openmm import app
+from scipy.optimize import minimize
+from protocolinterface import val
+
+try:
+    from simtk import unit
+    from simtk import openmm
+except ImportError:
+    unit = None
+    openmm = None
 
 from moleculekit.dihedral import dihedralAngle
-from parameterize.qm.base import QMBase, QMResult
+from parameterize.qm.base import (
+    QMBase,
+    QMResult,
+    _hasResult,
+    _loadResult,
+    _saveResult,
+)
+from parameterize.qm._mm import (
+    _getDihedralRestraint,
+    _getPrmtop,
+    _KCAL_TO_KJ,
+    _RESTRAINT_CONSTANT,
+)
 from ffevaluation.ffevaluate import FFEvaluate
 from parameterize.parameterization.util import getDipole
 
 logger = logging.getLogger(__name__)
 
+_frame_runner = None  # Frame runner of a worker process
+
+
+def _initFrameWorker(runner):
+    global _frame_runner
+    _frame_runner = runner
+
+
+def _runFrameWorker(iframe):
+    return _frame_runner(iframe)
+
+
+def _mapFrames(runner, iframes, nprocs):
+    """
+    Compute the frames with a runner, in parallel using up to nprocs processes
+
+    The results are yielded in order as soon as they are ready, so the caller can save each of
+    them before the rest are done.
+    """
+
+    processes = min(nprocs, len(iframes))
+    if processes > 1:
+        # The runner is sent to each worker just once
+        with Pool(processes, initializer=_initFrameWorker, initargs=(runner,)) as pool:
+            yield from pool.imap(_runFrameWorker, iframes)
+    else:
+        for iframe in iframes:
+            yield runner(iframe)
+
+
+def _computeESP(esp_points, coords, charges, block_size=4096):
+    """
+    Compute ESP values of the charges at the ESP points
+
+    The points are processed in blocks, so the distance matrix stays in cache and its reciprocal
+    is computed in place. The Angstrom --> Bohr conversion is applied once to the final values.
+    """
+    charges = np.asarray(charges, dtype=np.float64)
+    esp_values = np.empty(len(esp_points))
+    for start in range(0, len(esp_points), block_size):
+        stop = start + block_size
+        distances = cdist(esp_points[start:stop], coords)  # Angstrom
+        np.reciprocal(distances, out=distances)
+        np.dot(distances, charges, out=esp_values[start:stop])
+    esp_values /= (
+        const.physical_constants["Bohr radius"][0] / const.angstrom
+    )  # Angstrom --> Bohr
+    return esp_values  # Hartree/Bohr
+
+
+class _FakeQMFrameRunner:
+    """
+    Compute a frame of FakeQM
+    """
+
+    def __init__(
+        self, molecule, parameters, optimize, restrained_dihedrals, esp_points
+    ):
+        self.molecule = molecule
+        self.optimize = optimize
+        self.restrained_dihedrals = restrained_dihedrals
+        self.esp_points = esp_points
+        self.ff = FFEvaluate(molecule, parameters)
+
+    def __call__(self, iframe):
+
+        ff = self.ff
+        self.molecule.frame = iframe
+
+        result = QMResult()
+        result.errored = False
+        coords = self.molecule.coords[:, :, iframe : iframe + 1]
+
+        if self.optimize:
+            dihedrals = np.zeros((0, 4), dtype=np.int64)
+            if self.restrained_dihedrals is not None:
+                dihedrals = np.array(self.restrained_dihedrals, dtype=np.int64)
+            ref_angles = np.array(
+                [
+                    dihedralAngle(self.molecule.coords[dihedral, :, iframe])
+                    for dihedral in dihedrals
+                ]
+            )
+
+            def goalFunc(x):
+                x = x.reshape((-1, 3))
+                energies, forces, _ = ff.calculate(x)
+                energy = energies.sum()
+                grad = -forces[:, :, 0].astype(np.float64)
+                if len(dihedrals) > 0:
+                    restraint_energy, restraint_grad = _getDihedralRestraint(
+                        x, dihedrals, ref_angles, _RESTRAINT_CONSTANT
+                    )
+                    energy += restraint_energy
+                    grad += restraint_grad
+                return energy, grad.reshape(-1)
+
+            opt = minimize(
+                goalFunc,
+                coords.astype(np.float64).ravel(),
+                method="L-BFGS-B",
+                jac=True,
+                options={"gtol": 1e-3},
+            )
+            result.coords = opt.x.reshape((-1, 3, 1))
+            logger.info("Optimization status: %s" % opt.message)
+        else:
+            result.coords = coords.copy()
+
+        result.energy = ff.calculateEnergies(result.coords[:, :, 0])["total"]
+        result.dipole = getDipole(self.molecule)
+
+        if self.optimize:
+            # A self-consistency test
+            restraint_energy, _ = _getDihedralRestraint(
+                result.coords[:, :, 0], dihedrals, ref_angles, _RESTRAINT_CONSTANT
+            )
+            assert np.isclose(opt.fun, result.energy + restraint_energy)
+
+        # Compute ESP values
+        if self.esp_points is not None:
+            assert self.molecule.numFrames == 1
+            result.esp_points = self.esp_points
+            result.esp_values = _computeESP(
+                result.esp_points, result.coords[:, :, 0], self.molecule.charge
+            )
+
+        return result
+
+
+class _FakeQM2FrameRunner:
+    """
+    Compute a frame of FakeQM2
+
+    The OpenMM context cannot be pickled, so it is created lazily in each process. If threads is
+    set, the context uses that many CPU threads instead of one per core.
+    """
+
+    def __init__(
+        self,
+        molecule,
+        system,
+        groups,
+        optimize,
+        restrained_dihedrals,
+        esp_points,
+        threads=None,
+    ):
+        self.molecule = molecule
+        self.system = openmm.XmlSerializer.serialize(system)
+        self.groups = groups
+        self.optimize = optimize
+        self.restrained_dihedrals = restrained_dihedrals
+        self.esp_points = esp_points
+        self.threads = threads
+        self._context = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_context"] = None
+        return state
+
+    def _getContext(self):
+        if self._context is None:
+            system = openmm.XmlSerializer.deserialize(self.system)
+            properties = {} if self.threads is None else {"Threads": str(self.threads)}
+            self._context = openmm.Context(
+                system,
+                openmm.VerletIntegrator(1 * unit.femtosecond),
+                openmm.Platform.getPlatformByName("CPU"),
+                properties,
+            )
+            # The restraint is the last force, if present
+            self._restraint = system.getForce(system.getNumForces() - 1)
+        return self._context
+
+    def __call__(self, iframe):
+
+        context = self._getContext()
+        self.molecule.frame = iframe
+
+        context.setPositions(self.molecule.coords[:, :, iframe] * unit.angstrom)
+        if self.optimize:
+            if self.restrained_dihedrals is not None:
+                restraint = self._restraint
+                for i, dihedral in enumerate(self.restrained_dihedrals):
+                    ref_angle = np.rad2deg(
+                        dihedralAngle(self.molecule.coords[dihedral, :, iframe])
+                    )
+                    parameters = restraint.getTorsionParameters(i)
+                    parameters[5] = ref_angle * unit.degree
+                    restraint.setTorsionParameters(i, *parameters)
+                restraint.updateParametersInContext(context)
+
+            # Simulation.minimizeEnergy(tolerance=0.001 * kilocalorie_per_mole) passed this value
+            openmm.LocalEnergyMinimizer.minimize(context, 0.001 * _KCAL_TO_KJ)
+        state = context.getState(getEnergy=True, getPositions=True, groups=self.groups)
+
+        result = QMResult()
+        result.errored = False
+        result.energy = state.getPotentialEnergy().value_in_unit(
+            unit.kilocalorie_per_mole
+        )
+        result.coords = (
+            state.getPositions(asNumpy=True)
+            .value_in_unit(unit.angstrom)
+            .reshape((-1, 3, 1))
+        )
+        result.dipole = getDipole(self.molecule)
+
+        if self.esp_points is not None:
+            assert self.molecule.numFrames == 1
+            result.esp_points = self.esp_points
+            result.esp_values = _computeESP(
+                result.esp_points, result.coords[:, :, 0], self.molecule.charge
+            )
+
+        return result
+
 
 class FakeQM(QMBase):
     """
@@ -76,9 +310,9 @@ class FakeQM(QMBase):
     ...     qm.directory = tmpDir
     ...     result = qm.run()[0]
     >>> result.energy # doctest: +ELLIPSIS
-    7.697...
+    7.693...
     >>> np.rad2deg(dihedralAngle(result.coords[[2, 0, 1, 3], :, 0])) # doctest: +ELLIPSIS
-    102.57...
+    104.8...
 
     Run a constrained minimization
     >>> with TemporaryDirectory() as tmpDir:
@@ -90,9 +324,9 @@ class FakeQM(QMBase):
     ...     qm.directory = tmpDir
     ...     result = qm.run()[0]
     >>> result.energy # doctest: +ELLIPSIS
-    7.872...
-    >>> np.rad2deg(dihedralAngle(result.coords[[2, 0, 1, 3], :, 0])) # doctest: +ELLIPSIS
-    89.99...
+    7.87...
+    >>> round(float(np.rad2deg(dihedralAngle(result.coords[[2, 0, 1, 3], :, 0]))), 1)
+    90.0
     """
 
     # Fake implementations of the abstract methods
@@ -113,85 +347,43 @@ class FakeQM(QMBase):
 
     def __init__(self):
         super().__init__()
+        self._arg(
+            "nprocs",
+            "int",
+            "Number of processes to compute the frames in parallel",
+            default=1,
+            validator=val.Number(int, "POS"),
+        )
         self._parameters = None
 
     def _completed(self, directory):
-        return os.path.exists(os.path.join(directory, "data.pkl"))
+        return _hasResult(directory)
 
     def retrieve(self):
 
-        ff = FFEvaluate(self.molecule, self._parameters)
-
-        results = []
+        results = [None] * self.molecule.numFrames
+        iframes = []
         for iframe in range(self.molecule.numFrames):
-            self.molecule.frame = iframe
-
             directory = os.path.join(self.directory, "%05d" % iframe)
             os.makedirs(directory, exist_ok=True)
-            pickleFile = os.path.join(directory, "data.pkl")
 
             if self._completed(directory):
-                with open(pickleFile, "rb") as fd:
-                    result = pickle.load(fd)
-                logger.info("Loading QM data from %s" % pickleFile)
-
+                results[iframe] = _loadResult(directory)
+                logger.info("Loading QM data from %s" % directory)
             else:
-                result = QMResult()
-                result.errored = False
-                result.coords = self.molecule.coords[:, :, iframe : iframe + 1].copy()
-
-                if self.optimize:
-                    opt = nlopt.opt(nlopt.LN_COBYLA, result.coords.size)
-                    opt.set_min_objective(
-                        lambda x, _: ff.calculateEnergies(x.reshape((-1, 3)))["total"]
-                    )
-                    if self.restrained_dihedrals is not None:
-                        for dihedral in self.restrained_dihedrals:
-                            indices = dihedral.copy()
-                            ref_angle = dihedralAngle(
-                                self.molecule.coords[indices, :, iframe]
-                            )
-
-                            def constraint(x, _):
-                                coords = x.reshape((-1, 3))
-                                angle = dihedralAngle(coords[indices])
-                                return np.sin(0.5 * (angle - ref_angle))
-
-                            opt.add_equality_constraint(constraint)
-                    opt.set_xtol_abs(1e-3)  # Similar to Psi4 default
-                    opt.set_maxeval(1000 * opt.get_dimension())
-                    opt.set_initial_step(1e-3)
-                    result.coords = opt.optimize(result.coords.ravel()).reshape(
-                        (-1, 3, 1)
-                    )
-                    logger.info("Optimization status: %d" % opt.last_optimize_result())
-
-                result.energy = ff.calculateEnergies(result.coords[:, :, 0])["total"]
-                result.dipole = getDipole(self.molecule)
-
-                if self.optimize:
-                    assert (
-                        opt.last_optimum_value() == result.energy
-                    )  # A self-consistency test
-
-                # Compute ESP values
-                if self.esp_points is not None:
-                    assert self.molecule.numFrames == 1
-                    result.esp_points = self.esp_points
-                    distances = cdist(
-                        result.esp_points, result.coords[:, :, 0]
-                    )  # Angstrom
-                    distances *= (
-                        const.physical_constants["Bohr radius"][0] / const.angstrom
-                    )  # Angstrom --> Bohr
-                    result.esp_values = np.dot(
-                        np.reciprocal(distances), self.molecule.charge
-                    )  # Hartree/Bohr
-
-                with open(pickleFile, "wb") as fd:
-                    pickle.dump(result, fd)
-
-            results.append(result)
+                iframes.append(iframe)
+
+        # Compute the remaining frames
+        runner = _FakeQMFrameRunner(
+            self.molecule,
+            self._parameters,
+            self.optimize,
+            self.restrained_dihedrals,
+            self.esp_points,
+        )
+        for iframe, result in zip(iframes, _mapFrames(runner, iframes, self.nprocs)):
+            _saveResult(os.path.join(self.directory, "%05d" % iframe), result)
+            results[iframe] = result
 
         return results
 
@@ -267,38 +459,24 @@ class FakeQM2(FakeQM):
     """
 
     def _get_prmtop(self):
-        from parameterize.parameterization.writers import (
-            writeFRCMOD,
-            getAtomTypeMapping,
-        )
+        return _getPrmtop(self.molecule, self._parameters)
 
-        with TemporaryDirectory() as tmpDir:
-            frcFile = os.path.join(tmpDir, "mol.frcmod")
-            mapping = getAtomTypeMapping(self._parameters)
-            writeFRCMOD(self.molecule, self._parameters, frcFile, typemap=mapping)
-            mol2 = self.molecule.copy()
-            mol2.atomtype[:] = np.vectorize(mapping.get)(mol2.atomtype)
-            molFile = os.path.join(tmpDir, "mol.mol2")
-            mol2.write(molFile)
-
-            with open(os.path.join(tmpDir, "tleap.inp"), "w") as file:
-                file.writelines(
-                    (
-                        "loadAmberParams %s\n" % frcFile,
-                        "MOL = loadMol2 %s\n" % molFile,
-                        "saveAmberParm MOL mol.prmtop mol.inpcrd\n",
-                        "quit",
-                    )
-                )
-
-            with open(os.path.join(tmpDir, "tleap.out"), "w") as out:
-                call(("tleap", "-f", "tleap.inp"), cwd=tmpDir, stdout=out)
+    def retrieve(self):
 
-            prmtop = app.AmberPrmtopFile(os.path.join(tmpDir, "mol.prmtop"))
+        results = [None] * self.molecule.numFrames
+        iframes = []
+        for iframe in range(self.molecule.numFrames):
+            directory = os.path.join(self.directory, "%05d" % iframe)
+            os.makedirs(directory, exist_ok=True)
 
-        return prmtop
+            if self._completed(directory):
+                results[iframe] = _loadResult(directory)
+                logger.info("Loading QM data from %s" % directory)
+            else:
+                iframes.append(iframe)
 
-    def retrieve(self):
+        if len(iframes) == 0:
+            return results
 
         prmtop = self._get_prmtop()
         system = prmtop.createSystem()
@@ -319,75 +497,27 @@ class FakeQM2(FakeQM):
 
                 system.addForce(restraint)
 
-        simulation = app.Simulation(
-            prmtop.topology,
+        # Compute the remaining frames
+        runner = _FakeQM2FrameRunner(
+            self.molecule,
             system,
-            openmm.VerletIntegrator(1 * unit.femtosecond),
-            openmm.Platform.getPlatformByName("CPU"),
+            groups,
+            self.optimize,
+            self.restrained_dihedrals,
+            self.esp_points,
+            # Each process gets one thread, so the processes do not oversubscribe the CPUs
+            threads=1 if self.nprocs > 1 else None,
         )
-
-        results = []
         molecule_copy = self.molecule.copy()
-        for iframe in range(self.molecule.numFrames):
+        for iframe, result in zip(iframes, _mapFrames(runner, iframes, self.nprocs)):
             self.molecule.frame = iframe
             molecule_copy.frame = iframe
-
             directory = os.path.join(self.directory, "%05d" % iframe)
-            os.makedirs(directory, exist_ok=True)
-            pickleFile = os.path.join(directory, "data.pkl")
-
-            if self._completed(directory):
-                with open(pickleFile, "rb") as fd:
-                    results.append(pickle.load(fd))
-                logger.info("Loading QM data from %s" % pickleFile)
-                continue
-
-            simulation.context.setPositions(
-                self.molecule.coords[:, :, iframe] * unit.angstrom
-            )
-            if self.optimize:
-                if self.restrained_dihedrals is not None:
-                    for i, dihedral in enumerate(self.restrained_dihedrals):
-                        ref_angle = np.rad2deg(
-                            dihedralAngle(self.molecule.coords[dihedral, :, iframe])
-                        )
-                        parameters = restraint.getTorsionParameters(i)
-                        parameters[5] = ref_angle * unit.degree
-                        restraint.setTorsionParameters(i, *parameters)
-                    restraint.updateParametersInContext(simulation.context)
-                simulation.minimizeEnergy(tolerance=0.001 * unit.kilocalorie_per_mole)
-            state = simulation.context.getState(
-                getEnergy=True, getPositions=True, groups=groups
-            )
 
-            result = QMResult()
             result.charge = self.charge
-            result.errored = False
-            result.energy = state.getPotentialEnergy().value_in_unit(
-                unit.kilocalorie_per_mole
-            )
-            result.coords = (
-                state.getPositions(asNumpy=True)
-                .value_in_unit(unit.angstrom)
-                .reshape((-1, 3, 1))
-            )
-            result.dipole = getDipole(self.molecule)
-
-            if self.esp_points is not None:
-                assert self.molecule.numFrames == 1
-                result.esp_points = self.esp_points
-                distances = cdist(result.esp_points, result.coords[:, :, 0])  # Angstrom
-                distances *= (
-                    const.physical_constants["Bohr radius"][0] / const.angstrom
-                )  # Angstrom --> Bohr
-                result.esp_values = np.dot(
-                    np.reciprocal(distances), self.molecule.charge
-                )  # Hartree/Bohr
-
-            results.append(result)
-
-            with open(pickleFile, "wb") as fd:
-                pickle.dump(result, fd)
+            results[iframe] = result
+
+            _saveResult(directory, result)
 
             self.molecule.write(
                 os.path.join(directory, "mol-init.mol2")
@@ -4,13 +4,15 @@
 # No redistribution in whole or part
 #
 import os
+import pickle
 import unittest
 from tempfile import TemporaryDirectory
 import numpy as np
+import parmed
 
 from parameterize.home import home
-from parameterize.qm.base import QMBase
-from parameterize.qm import Psi4, TeraChem, Gaussian
+from parameterize.qm.base import QMBase, QMResult, _hasResult, _loadResult, _saveResult
+from parameterize.qm import Psi4, TeraChem, Gaussian, FakeQM
 from jobqueues.localqueue import LocalCPUQueue
 from jobqueues.slurmqueue import SlurmQueue
 from moleculekit.molecule import Molecule
@@ -491,5 +493,93 @@ class _TestGaussian(_TestBase, unittest.TestCase):
         super().setUp()
 
 
+class _TestResultIO(unittest.TestCase):
+    def setUp(self):
+
+        self.result = QMResult()
+        self.result.errored = False
+        self.result.energy = -94970.49912
+        self.result.charge = 0
+        self.result.calculator_time = 0.25
+        self.result.coords = np.arange(12, dtype=np.float32).reshape((4, 3, 1))
+        self.result.dipole = [0.1, 0.2, 0.3, 0.374]
+
+    def test_save_load(self):
+
+        with TemporaryDirectory() as tmpDir:
+            self.assertFalse(_hasResult(tmpDir))
+            _saveResult(tmpDir, self.result)
+            self.assertTrue(_hasResult(tmpDir))
+            self.assertTrue(os.path.exists(os.path.join(tmpDir, "data.npz")))
+            result = _loadResult(tmpDir)
+
+        # The scalars are read back as Python objects
+        self.assertIs(result.errored, False)
+        self.assertIsInstance(result.energy, float)
+        self.assertEqual(self.result.energy, result.energy)
+        self.assertIsInstance(result.charge, int)
+        self.assertEqual(self.result.charge, result.charge)
+        self.assertEqual(self.result.calculator_time, result.calculator_time)
+
+        # The arrays keep their shape and type
+        self.assertEqual(np.float32, result.coords.dtype)
+        self.assertTrue(np.array_equal(self.result.coords, result.coords))
+        self.assertTrue(np.array_equal(self.result.dipole, result.dipole))
+
+        # The unset attributes stay None
+        self.assertIsNone(result.esp_points)
+        self.assertIsNone(result.esp_values)
+
+    def test_load_legacy_pickle(self):
+
+        with TemporaryDirectory() as tmpDir:
+            with open(os.path.join(tmpDir, "data.pkl"), "wb") as fd:
+                pickle.dump(self.result, fd)
+            self.assertTrue(_hasResult(tmpDir))
+            result = _loadResult(tmpDir)
+
+        self.assertIsInstance(result, QMResult)
+        self.assertEqual(self.result.energy, result.energy)
+        self.assertEqual(self.result.dipole, result.dipole)
+        self.assertTrue(np.array_equal(self.result.coords, result.coords))
+
+
+class _TestFakeQM(unittest.TestCase):
+    def setUp(self):
+
+        paramDir = os.path.join(home("test-param"), "h2o2_min", "parameters", "GAFF2")
+        self.parameters = parmed.amber.AmberParameterSet(
+            os.path.join(paramDir, "mol.frcmod")
+        )
+
+        molFile = os.path.join(home("test-qm"), "H2O2-90.mol2")
+        self.h2o2_90 = Molecule(molFile, guessNE="bonds", guess=("angles", "dihedrals"))
+        self.h2o2_90.atomtype[:] = Molecule(os.path.join(paramDir, "mol.mol2")).atomtype
+
+    def test_nprocs(self):
+
+        mol = self.h2o2_90.copy()
+        noise = np.random.RandomState(0).normal(0, 0.05, (mol.numAtoms, 3, 4))
+        mol.coords = (mol.coords + noise).astype(np.float32)
+
+        results = {}
+        for nprocs in (1, 2):
+            with TemporaryDirectory() as tmpDir:
+                qm = FakeQM()
+                qm.molecule = mol
+                qm._parameters = self.parameters
+                qm.optimize = True
+                qm.restrained_dihedrals = np.array([[2, 0, 1, 3]])
+                qm.nprocs = nprocs
+                qm.directory = tmpDir
+                results[nprocs] = qm.run()
+
+        self.assertEqual(4, len(results[2]))
+        for serial, parallel in zip(results[1], results[2]):
+            self.assertFalse(parallel.errored)
+            self.assertEqual(serial.energy, parallel.energy)
+            self.assertTrue(np.array_equal(serial.coords, parallel.coords))
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)